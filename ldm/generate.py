@@ -121,6 +121,10 @@ gr = Generate(
           model:str         = symbolic name of the model in the configuration file
           precision:float   = float precision to be used
           safety_checker:bool = activate safety checker [False]
+          mmap_weights:bool = memory-map checkpoint files when loading them [True]
+          quantize_cpu_cache:bool = keep float32 models in the RAM cache at float16 [False]
+          max_cache_ram:float = GB of system RAM the model cache may use [no limit]
+          trust_weights_only:bool = load checkpoints with torch's weights_only unpickler instead of scanning them [True]
 
           # this value is sticky and maintained between generation calls
           sampler_name:str  = ['ddim', 'k_dpm_2_a', 'k_dpm_2', 'k_dpmpp_2', 'k_dpmpp_2_a', 'k_euler_a', 'k_euler', 'k_heun', 'k_lms', 'plms']  // k_lms
@@ -153,6 +157,10 @@ class Generate:
             free_gpu_mem=False,
             safety_checker:bool=False,
             max_loaded_models:int=2,
+            mmap_weights:bool=True,
+            quantize_cpu_cache:bool=False,
+            trust_weights_only:bool=True,
+            max_cache_ram:float=None,
             # these are deprecated; if present they override values in the conf file
             weights = None,
             config = None,
@@ -189,6 +197,7 @@ class Generate:
         self.size_matters = True  # used to warn once about large image sizes and VRAM
         self.txt2mask = None
         self.safety_checker = None
+        self.safety_feature_extractor = None
         self.karras_max = None
         self.infill_method = None
 
@@ -206,9 +215,30 @@ class Generate:
             self.precision = 'float32'
         if self.precision == 'auto':
             self.precision = choose_precision(self.device)
+        if self.precision == 'float16' and self.device.type == 'cpu':
+            raise ValueError('--precision=float16 requires a GPU, but no CUDA or MPS device is available. Use --precision=float32 instead')
+
+        # let cuDNN pick the fastest kernels for our (fixed) shapes, and use
+        # TF32 tensor cores on Ampere and later. Users who ask for float32
+        # explicitly want full accuracy, so leave them alone.
+        if self._has_cuda() and self.precision != 'float32':
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            if hasattr(torch, 'set_float32_matmul_precision'):
+                torch.set_float32_matmul_precision('high')
 
         # model caching system for fast switching
-        self.model_cache = ModelCache(mconfig,self.device,self.precision,max_loaded_models=max_loaded_models)
+        self.model_cache = ModelCache(
+            mconfig,
+            self.device,
+            self.precision,
+            max_loaded_models  = max_loaded_models,
+            max_cache_bytes    = int(max_cache_ram*1e9) if max_cache_ram else None,
+            mmap_weights       = mmap_weights,
+            quantize_cpu_cache = quantize_cpu_cache,
+            trust_weights_only = trust_weights_only,
+        )
         self.model_name  = model or self.model_cache.default_model() or FALLBACK_MODEL_NAME
 
         # for VRAM usage statistics
@@ -218,26 +248,34 @@ class Generate:
         # gets rid of annoying messages about random seed
         logging.getLogger('pytorch_lightning').setLevel(logging.ERROR)
 
-        # load safety checker if requested
-        if safety_checker:
-            try:
-                print('>> Initializing safety checker')
-                from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-                from transformers import AutoFeatureExtractor
-                safety_model_id = "CompVis/stable-diffusion-safety-checker"
-                safety_model_path = os.path.join(Globals.root,'models',safety_model_id)
-                self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id,
-                                                                                   local_files_only=True,
-                                                                                   cache_dir=safety_model_path,
-                )
-                self.safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id,
-                                                                                     local_files_only=True,
-                                                                                     cache_dir=safety_model_path,
-                )
-                self.safety_checker.to(self.device)
-            except Exception:
-                print('** An error was encountered while installing the safety checker:')
-                print(traceback.format_exc())
+        # the safety checker is loaded the first time it is needed
+        self.use_safety_checker = safety_checker
+
+    def _load_safety_checker(self):
+        '''
+        Load the safety checker and its feature extractor. This is deferred
+        until the first generation so that startup does not pay for it.
+        '''
+        try:
+            print('>> Initializing safety checker')
+            from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+            from transformers import AutoFeatureExtractor
+            safety_model_id = "CompVis/stable-diffusion-safety-checker"
+            safety_model_path = os.path.join(Globals.root,'models',safety_model_id)
+            self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id,
+                                                                               local_files_only=True,
+                                                                               cache_dir=safety_model_path,
+            )
+            self.safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id,
+                                                                                 local_files_only=True,
+                                                                                 cache_dir=safety_model_path,
+            )
+            self.safety_checker.to(self.device)
+        except Exception:
+            print('** An error was encountered while installing the safety checker:')
+            print(traceback.format_exc())
+            self.safety_checker = None
+            self.use_safety_checker = False
 
     def prompt2png(self, prompt, outdir, **kwargs):
         """
@@ -485,6 +523,9 @@ class Generate:
             )
             generator.use_mps_noise = use_mps_noise
 
+            if self.use_safety_checker and self.safety_checker is None:
+                self._load_safety_checker()
+
             checker = {
                 'checker':self.safety_checker,
                 'extractor':self.safety_feature_extractor
@@ -825,6 +866,28 @@ class Generate:
         '''
         self.set_model(self.model_name)
 
+    def warmup(self):
+        '''
+        Run a tiny throwaway generation so that GPU context creation,
+        kernel loading and allocator setup happen now rather than on
+        the first real request. This does not pre-tune cuDNN: with
+        cudnn.benchmark set, algorithms are chosen per input shape, and
+        the 64x64 choices do not carry over to real image sizes. Only
+        worth calling on a CUDA or MPS device.
+        '''
+        print('>> Warming up model')
+        tic = time.time()
+        try:
+            self.prompt2image(prompt='warmup', steps=1, width=64, height=64, iterations=1)
+        except Exception:
+            print('** An error was encountered during model warmup:')
+            print(traceback.format_exc())
+            return
+        if self._has_cuda():
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+        print('>> Warmup done in', '%4.2fs' % (time.time() - tic))
+
     def set_model(self,model_name):
         """
         Given the name of a model defined in models.yaml, will load and initialize it
@@ -1142,8 +1205,7 @@ class Generate:
 
     def write_intermediate_images(self,modulus,path):
         counter = -1
-        if not os.path.exists(path):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
         def callback(img):
             nonlocal counter
             counter += 1
@@ -6,10 +6,14 @@ import copy
 import warnings
 import time
 import traceback
+import contextlib
 import yaml
 
+# load CUDA kernels on demand rather than all at once when the context is
+# created. This must be set before torch initializes CUDA.
+os.environ.setdefault('CUDA_MODULE_LOADING', 'LAZY')
+
 from ldm.invoke.globals import Globals
-from ldm.generate import Generate
 from ldm.invoke.prompt_parser import PromptParser
 from ldm.invoke.readline import get_completer, Completer
 from ldm.invoke.args import Args, metadata_dumps, metadata_from_png, dream_cmd_from_png
@@ -24,6 +28,9 @@ import pyparsing
 # global used in multiple functions (fix)
 infile = None
 
+# the stable-diffusion package directory, which the web server runs from
+LDM_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
 def main():
     """Initialize command-line parsers and the diffusion model"""
     global infile
@@ -52,29 +59,20 @@ def main():
             sys.exit(-1)
 
     print(f'>> InvokeAI runtime directory is "{Globals.root}"')
+    startup_tic = time.perf_counter()
 
-    # loading here to avoid long delays on startup
-    from ldm.generate import Generate
-
-    # these two lines prevent a horrible warning message from appearing
-    # when the frozen CLIP tokenizer is imported
-    import transformers
-    transformers.logging.set_verbosity_error()
+    # loading here to avoid long delays on startup. Generate() takes care
+    # of silencing the transformers warnings about the CLIP tokenizer.
+    with startup_phase('imports'):
+        from ldm.generate import Generate
 
     # Loading Face Restoration and ESRGAN Modules
-    gfpgan,codeformer,esrgan = load_face_restoration(opt)
+    with startup_phase('restoration'):
+        gfpgan,codeformer,esrgan = load_face_restoration(opt)
 
     # normalize the config directory relative to root
-    if not os.path.isabs(opt.conf):
-        opt.conf = os.path.normpath(os.path.join(Globals.root,opt.conf))
-
-    if opt.embeddings:
-        if not os.path.isabs(opt.embedding_path):
-            embedding_path = os.path.normpath(os.path.join(Globals.root,opt.embedding_path))
-        else:
-            embedding_path = opt.embedding_path
-    else:
-        embedding_path = None
+    opt.conf = resolve_root_path(opt.conf)
+    embedding_path = resolve_root_path(opt.embedding_path) if opt.embeddings else None
 
     # load the infile as a list of lines
     if opt.infile:
@@ -91,24 +89,29 @@ def main():
 
     # creating a Generate object:
     try:
-        gen = Generate(
-            conf = opt.conf,
-            model = opt.model,
-            sampler_name = opt.sampler_name,
-            embedding_path = embedding_path,
-            full_precision = opt.full_precision,
-            precision = opt.precision,
-            gfpgan=gfpgan,
-            codeformer=codeformer,
-            esrgan=esrgan,
-            free_gpu_mem=opt.free_gpu_mem,
-            safety_checker=opt.safety_checker,
-            max_loaded_models=opt.max_loaded_models,
-            )
+        with startup_phase('Generate()'):
+            gen = Generate(
+                conf = opt.conf,
+                model = opt.model,
+                sampler_name = opt.sampler_name,
+                embedding_path = embedding_path,
+                full_precision = opt.full_precision,
+                precision = opt.precision,
+                gfpgan=gfpgan,
+                codeformer=codeformer,
+                esrgan=esrgan,
+                free_gpu_mem=opt.free_gpu_mem,
+                safety_checker=opt.safety_checker,
+                max_loaded_models=opt.max_loaded_models,
+                max_cache_ram=opt.max_cache_ram,
+                mmap_weights=opt.mmap_weights,
+                quantize_cpu_cache=opt.quantize_cpu_cache,
+                trust_weights_only=opt.trust_weights_only,
+                )
     except (FileNotFoundError, TypeError, AssertionError):
         emergency_model_reconfigure(opt)
         sys.exit(-1)
-    except (IOError, KeyError) as e:
+    except (IOError, KeyError, ValueError) as e:
         print(f'{e}. Aborting.')
         sys.exit(-1)
 
@@ -117,16 +120,24 @@ def main():
 
     # preload the model
     try:
-        gen.load_model()
+        with startup_phase('model load'):
+            gen.load_model()
     except AssertionError:
         emergency_model_reconfigure(opt)
         sys.exit(-1)
 
     # web server loops forever
     if opt.web or opt.gui:
+        # on the CPU there is no device context or kernel loading to get
+        # out of the way, so a warmup run would only delay startup
+        if gen.device.type in ('cuda', 'mps'):
+            with startup_phase('warmup'):
+                gen.warmup()
+        print_startup_time(startup_tic)
         invoke_ai_web_server_loop(gen, gfpgan, codeformer, esrgan)
         sys.exit(0)
 
+    print_startup_time(startup_tic)
     if not infile:
         print(
             "\n* Initialization done! Awaiting your command (-h for help, 'q' to quit)"
@@ -265,19 +276,14 @@ def main_loop(gen, opt):
             current_outdir = os.path.join(opt.outdir, subdir)
 
             print('Writing files to directory: "' + current_outdir + '"')
-
-            # make sure the output directory exists
-            if not os.path.exists(current_outdir):
-                os.makedirs(current_outdir)
         else:
-            if not os.path.exists(opt.outdir):
-                os.makedirs(opt.outdir)
             current_outdir = opt.outdir
 
         # Here is where the images are actually generated!
         last_results = []
+        file_writer = None
         try:
-            file_writer      = PngWriter(current_outdir)
+            file_writer      = PngWriter(current_outdir, background=True) # creates current_outdir if needed
             results          = []  # list of filename, prompt pairs
             grid_images      = dict()  # seed -> Image, only used if `opt.grid`
             prior_variations = opt.with_variations or []
@@ -313,6 +319,8 @@ def main_loop(gen, opt):
                     if use_prefix is not None:
                         prefix = use_prefix
                     postprocessed = upscaled if upscaled else operation=='postprocess'
+                    if postprocessed:
+                        file_writer.flush()  # postprocessed names depend on which files exist
                     opt.prompt = gen.concept_lib().replace_triggers_with_concepts(opt.prompt or prompt_in)  # to avoid the problem of non-unique concept triggers
                     filename, formatted_dream_prompt = prepare_image_metadata(
                         opt,
@@ -337,6 +345,7 @@ def main_loop(gen, opt):
 
                     # update rfc metadata
                     if operation == 'postprocess':
+                        file_writer.flush()  # metadata is patched into the file just written
                         tool = re.match('postprocess:(\w+)',opt.last_operation).groups()[0]
                         add_postprocessing_to_metadata(
                             opt,
@@ -397,6 +406,9 @@ def main_loop(gen, opt):
                 )
                 results = [[path, formatted_dream_prompt]]
 
+            # make sure all images are on disk before reporting them
+            file_writer.flush()
+
         except AssertionError as e:
             print(e)
             continue
@@ -405,6 +417,15 @@ def main_loop(gen, opt):
             print(e)
             continue
 
+        finally:
+            # on the error paths above, writes may still be pending, and the
+            # next command's unique_prefix() must see them on disk
+            if file_writer:
+                try:
+                    file_writer.close()
+                except OSError as e:
+                    print(e)
+
         print('Outputs:')
         log_path = os.path.join(current_outdir, 'invoke_log')
         output_cntr = write_log(results, log_path ,('txt', 'md'), output_cntr)
@@ -506,15 +527,34 @@ def do_command(command:str, gen, opt:Args, completer) -> tuple:
         command = '-h'
     return command, operation
 
+@contextlib.contextmanager
+def startup_phase(name:str):
+    '''
+    Time one phase of startup and report it on stderr, so that
+    it is clear where cold-start time is going.
+    '''
+    tic = time.perf_counter()
+    yield
+    print(f'>> [startup] {name}:', '%4.2fs' % (time.perf_counter() - tic), file=sys.stderr)
+
+def print_startup_time(tic:float):
+    print('>> [startup] total:', '%4.2fs' % (time.perf_counter() - tic), file=sys.stderr)
+
+def resolve_root_path(path:str) -> str:
+    '''
+    Return the path unchanged if it is absolute, otherwise
+    interpret it relative to the InvokeAI root directory.
+    '''
+    path = Path(path)
+    return str(path if path.is_absolute() else Path(Globals.root, path))
+
 def set_default_output_dir(opt:Args, completer:Completer):
     '''
     If opt.outdir is relative, we add the root directory to it
     normalize the outdir relative to root and make sure it exists.
     '''
-    if not os.path.isabs(opt.outdir):
-        opt.outdir=os.path.normpath(os.path.join(Globals.root,opt.outdir))
-    if not os.path.exists(opt.outdir):
-        os.makedirs(opt.outdir)
+    opt.outdir = resolve_root_path(opt.outdir)
+    os.makedirs(opt.outdir, exist_ok=True)
     completer.set_default_dir(opt.outdir)
 
 
@@ -689,11 +729,11 @@ def do_postprocess (gen, opt, callback):
             opt                 = opt,
         )
     except OSError:
-        print(traceback.format_exc(), file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
         print(f'** {file_path}: file could not be read')
         return
     except (KeyError, AttributeError):
-        print(traceback.format_exc(), file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
         return
     return opt.last_operation
 
@@ -792,13 +832,11 @@ def get_next_command(infile=None) -> str:  # command string
             print(f'#{command}')
     return command
 
-def invoke_ai_web_server_loop(gen: Generate, gfpgan, codeformer, esrgan):
+def invoke_ai_web_server_loop(gen: 'Generate', gfpgan, codeformer, esrgan):
     print('\n* --web was specified, starting web server...')
     from backend.invoke_ai_web_server import InvokeAIWebServer
     # Change working directory to the stable-diffusion directory
-    os.chdir(
-        os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    )
+    os.chdir(LDM_DIR)
 
     invoke_ai_web_server = InvokeAIWebServer(generate=gen, gfpgan=gfpgan, codeformer=codeformer, esrgan=esrgan)
 
@@ -856,7 +894,7 @@ def load_face_restoration(opt):
         else:
             print('>> Face restoration and upscaling disabled')
     except (ModuleNotFoundError, ImportError):
-        print(traceback.format_exc(), file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
         print('>> You may need to install the ESRGAN and/or GFPGAN modules')
     return gfpgan,codeformer,esrgan
 
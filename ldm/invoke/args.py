@@ -473,6 +473,13 @@ class Args(object):
             default=2,
             help='Maximum number of models to keep in memory for fast switching, including the one in GPU',
         )
+        model_group.add_argument(
+            '--max_cache_ram',
+            dest='max_cache_ram',
+            type=float,
+            default=None,
+            help='Maximum amount of system RAM, in GB, to use for models kept in memory for fast switching. By default only --max_loaded_models limits the cache',
+        )
         model_group.add_argument(
             '--free_gpu_mem',
             dest='free_gpu_mem',
@@ -496,6 +503,24 @@ class Args(object):
             default=False,
             help='Check for and blur potentially NSFW images. Use --no-nsfw_checker to disable.',
         )
+        model_group.add_argument(
+            '--mmap_weights',
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help='Memory-map model checkpoint files instead of reading them into RAM before loading. Use --no-mmap_weights to disable.',
+        )
+        model_group.add_argument(
+            '--quantize_cpu_cache',
+            action=argparse.BooleanOptionalAction,
+            default=False,
+            help='Keep float32 models at float16 precision while they are cached in system RAM, so that more of them fit. Has no effect with --precision=float16.',
+        )
+        model_group.add_argument(
+            '--trust_weights_only',
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Load checkpoints with torch's restricted weights_only unpickler instead of scanning them for malicious code first. Only used with torch >= 2.6 and --mmap_weights; checkpoints it cannot load are still scanned. Use --no-trust_weights_only to always scan.",
+        )
         model_group.add_argument(
             '--patchmatch',
             action=argparse.BooleanOptionalAction,
@@ -7,42 +7,79 @@ cleared and loaded from disk when next needed.
 
 import torch
 import os
-import io
 import time
 import gc
 import hashlib
+import inspect
+import itertools
+import json
+import mmap
+import pickle
 import psutil
+import re
 import sys
 import transformers
 import traceback
 import textwrap
-import contextlib
-from typing import Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from omegaconf import OmegaConf
-from omegaconf.errors import ConfigAttributeError
 from ldm.util import instantiate_from_config, ask_user
 from ldm.invoke.globals import Globals
 from picklescan.scanner import scan_file_path
 
+# Repeatedly loading and offloading multi-GB models fragments the CUDA
+# caching allocator. Expandable segments let it grow a reservation in
+# place instead. The allocator reads this when CUDA is first initialized,
+# which normally has not happened when this module is imported. Older torch
+# versions reject options they do not know about.
+if torch.__version__ >= '2.1':
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 DEFAULT_MAX_MODELS=2
+TORCH_VERSION=tuple(int(n) for n in re.findall(r'\d+', torch.__version__)[:2])
+TORCH_LOAD_HAS_WEIGHTS_ONLY='weights_only' in inspect.signature(torch.load).parameters
+# before torch 2.6, a crafted checkpoint could run code even through
+# torch.load(weights_only=True) (CVE-2025-32434)
+TORCH_WEIGHTS_ONLY_IS_SAFE=TORCH_VERSION >= (2, 6)
+HASH_CHUNK_SIZE=16<<20
+FINGERPRINT_SIZE=1<<20  # bytes read from each end of a weights file to fingerprint it
 
 class ModelCache(object):
-    def __init__(self, config:OmegaConf, device_type:str, precision:str, max_loaded_models=DEFAULT_MAX_MODELS):
+    def __init__(self, config:OmegaConf, device_type:str, precision:str, max_loaded_models=DEFAULT_MAX_MODELS, mmap_weights:bool=True, quantize_cpu_cache:bool=False, trust_weights_only:bool=True, max_cache_bytes:int=None):
         '''
         Initialize with the path to the models.yaml config file,
-        the torch device type, and precision. The optional
-        min_avail_mem argument specifies how much unused system
-        (CPU) memory to preserve. The cache of models in RAM will
-        grow until this value is approached. Default is 2G.
+        the torch device type, and precision. The cache holds at most
+        max_loaded_models models and, if max_cache_bytes is given,
+        takes up at most that much system (CPU) memory between them,
+        although the model in use is never purged to stay under it.
+        If mmap_weights is True, checkpoint files are memory-mapped
+        rather than read into RAM while being unpickled.
+        If quantize_cpu_cache is True, float32 models are kept in the RAM
+        cache at float16 precision and restored to float32 when moved back
+        to the GPU, so that each cached model takes half as much RAM.
+        If trust_weights_only is True, checkpoints are loaded with
+        torch.load(weights_only=True), which refuses to unpickle anything
+        but tensors and plain containers, in place of a picklescan pass.
+        This needs torch >= 2.6 and mmap_weights; see _load_weights().
         '''
         # prevent nasty-looking CLIP log message
         transformers.logging.set_verbosity_error()
         self.config = config
+        self._config_dict = None
         self.precision = precision
         self.device = torch.device(device_type)
         self.max_loaded_models = max_loaded_models
+        self.max_cache_bytes = max_cache_bytes
+        self.mmap_weights = mmap_weights
+        self.quantize_cpu_cache = quantize_cpu_cache
+        self.trust_weights_only = trust_weights_only
+        self._pin_memory = self._has_cuda()  # cleared if pinned allocations fail
+        if self._has_cuda():
+            print(f'>> CUDA allocator config: {os.environ.get("PYTORCH_CUDA_ALLOC_CONF") or "default"}')
         self.models = {}
-        self.stack = []  # this is an LRU FIFO
+        self.stack = OrderedDict()  # this is an LRU FIFO; the values are unused
         self.current_model = None
 
     def valid_model(self, model_name:str)->bool:
@@ -50,7 +87,7 @@ class ModelCache(object):
         Given a model name, returns True if it is a valid
         identifier.
         '''
-        return model_name in self.config
+        return model_name in self._model_configs()
 
     def get_model(self, model_name:str):
         '''
@@ -83,6 +120,7 @@ class ModelCache(object):
                     'width': width,
                     'height': height,
                     'hash': hash,
+                    'size': self._model_size(requested_model) // (2 if self._cpu_cache_dtype() else 1),
                 }
 
             except Exception as e:
@@ -95,6 +133,7 @@ class ModelCache(object):
 
         self.current_model = model_name
         self._push_newest_model(model_name)
+        self._trim_cache_to_budget()
         return {
             'model':requested_model,
             'width':width,
@@ -107,8 +146,8 @@ class ModelCache(object):
         Returns the name of the default model, or None
         if none is defined.
         '''
-        for model_name in self.config:
-            if self.config[model_name].get('default'):
+        for model_name, mconfig in self._model_configs().items():
+            if mconfig.get('default'):
                 return model_name
 
     def set_default_model(self,model_name:str) -> None:
@@ -122,6 +161,7 @@ class ModelCache(object):
         for model in config:
             config[model].pop('default',None)
         config[model_name]['default'] = True
+        self._config_dict = None
 
     def list_models(self) -> dict:
         '''
@@ -132,11 +172,8 @@ class ModelCache(object):
           model_name2: { etc }
         '''
         models = {}
-        for name in self.config:
-            try:
-                description = self.config[name].description
-            except ConfigAttributeError:
-                description = '<no description>'
+        for name, mconfig in self._model_configs().items():
+            description = mconfig.get('description', '<no description>')
 
             if self.current_model == name:
                 status = 'active'
@@ -168,8 +205,10 @@ class ModelCache(object):
         '''
         omega = self.config
         del omega[model_name]
-        if model_name in self.stack:
-            self.stack.remove(model_name)
+        self._config_dict = None
+        self.stack.pop(model_name,None)
+        if self.models.pop(model_name,None) is not None:
+            self._release_purged_memory()
 
     def add_model(self, model_name:str, model_attributes:dict, clobber=False) -> None:
         '''
@@ -189,6 +228,7 @@ class ModelCache(object):
             config[field] = model_attributes[field]
 
         omega[model_name] = config
+        self._config_dict = None
         if clobber:
             self._invalidate_cached_model(model_name)
 
@@ -198,35 +238,33 @@ class ModelCache(object):
             print(f'"{model_name}" is not a known model name. Please check your models.yaml file')
 
         mconfig = self.config[model_name]
-        config = mconfig.config
-        weights = mconfig.weights
+        config = self._resolve_path(mconfig.config)
+        weights = self._resolve_path(mconfig.weights)
         vae = mconfig.get('vae')
         width = mconfig.width
         height = mconfig.height
 
-        if not os.path.isabs(weights):
-            weights = os.path.normpath(os.path.join(Globals.root,weights))
-        # scan model
-        self.scan_model(model_name, weights)
+        # The hash of the weights file is computed in the background while
+        # the file is scanned (if it needs to be, see _load_weights()) and
+        # then loaded; all three read the same pages, so after the first pass
+        # the others are served from the page cache.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            model_hash = self._lookup_cached_sha256(weights)
+            hash_future = None if model_hash else executor.submit(self._compute_and_store_sha256, weights)
 
-        print(f'>> Loading {model_name} from {weights}')
+            print(f'>> Loading {model_name} from {weights}')
 
-        # for usage statistics
-        if self._has_cuda():
-            torch.cuda.reset_peak_memory_stats()
-            torch.cuda.empty_cache()
+            # for usage statistics
+            if self._has_cuda():
+                torch.cuda.reset_peak_memory_stats()
 
-        tic = time.time()
+            tic = time.time()
 
-        # this does the work
-        if not os.path.isabs(config):
-            config = os.path.join(Globals.root,config)
-        omega_config = OmegaConf.load(config)
-        with open(weights,'rb') as f:
-            weight_bytes = f.read()
-        model_hash  = self._cached_sha256(weights,weight_bytes)
-        sd = torch.load(io.BytesIO(weight_bytes), map_location='cpu')
-        del weight_bytes
+            # this does the work
+            omega_config = OmegaConf.load(config)
+            sd = self._load_weights(model_name, weights)
+            if hash_future:
+                model_hash = hash_future.result()
         # merged models from auto11 merge board are flat for some reason
         if 'state_dict' in sd:
             sd = sd['state_dict']
@@ -241,13 +279,15 @@ class ModelCache(object):
 
         # look and load a matching vae file. Code borrowed from AUTOMATIC1111 modules/sd_models.py
         if vae:
-            if not os.path.isabs(vae):
-                vae = os.path.normpath(os.path.join(Globals.root,vae))
+            vae = self._resolve_path(vae)
             if os.path.exists(vae):
                 print(f'   | Loading VAE weights from: {vae}')
-                vae_ckpt = torch.load(vae, map_location="cpu")
-                vae_dict = {k: v for k, v in vae_ckpt["state_dict"].items() if k[0:4] != "loss"}
+                vae_ckpt = self._load_weights(f'{model_name} VAE', vae)
+                vae_dict = vae_ckpt.get('state_dict', vae_ckpt)
+                for key in [k for k in vae_dict if k.startswith('loss')]:
+                    del vae_dict[key]
                 model.first_stage_model.load_state_dict(vae_dict, strict=False)
+                del vae_ckpt, vae_dict
             else:
                 print(f'   | VAE file {vae} not found. Skipping.')
 
@@ -257,9 +297,11 @@ class ModelCache(object):
 
         model.eval()
 
-        for module in model.modules():
-            if isinstance(module, (torch.nn.Conv2d, torch.nn.ConvTranspose2d)):
-                module._orig_padding_mode = module.padding_mode
+        # remember the convolutions once, so that seamless padding can be
+        # reconfigured without walking every module of the model again
+        model._conv_modules = [m for m in model.modules() if isinstance(m, (torch.nn.Conv2d, torch.nn.ConvTranspose2d))]
+        for module in model._conv_modules:
+            module._orig_padding_mode = module.padding_mode
 
         # usage statistics
         toc = time.time()
@@ -287,10 +329,6 @@ class ModelCache(object):
         model = self.models[model_name]['model']
         self.models[model_name]['model'] = self._model_to_cpu(model)
 
-        gc.collect()
-        if self._has_cuda():
-            torch.cuda.empty_cache()
-
     def scan_model(self, model_name, checkpoint):
         # scan model
         print(f'>> Scanning Model: {model_name}')
@@ -319,7 +357,51 @@ class ModelCache(object):
             print(f'>> Cache limit (max={self.max_loaded_models}) reached. Purging {least_recent_model}')
             if least_recent_model is not None:
                 del self.models[least_recent_model]
-                gc.collect()
+                self._release_purged_memory()
+
+    def _trim_cache_to_budget(self) -> None:
+        '''
+        Purge least recently used models until those in the cache take up
+        no more than max_cache_bytes. This is done once a model has been
+        loaded, when its size is known; the size of the weights file says
+        little about it. The current model is never purged, even if it
+        alone is over budget.
+        '''
+        if self.max_cache_bytes is None:
+            return
+        purged = False
+        for model_name in list(self.stack):
+            if self._cached_bytes() <= self.max_cache_bytes:
+                break
+            if model_name == self.current_model:
+                continue
+            print(f'>> Cache limit (max={self.max_cache_bytes/1e9:4.2f}G) reached. Purging {model_name}')
+            del self.stack[model_name]
+            self.models.pop(model_name,None)
+            purged = True
+        if purged:
+            self._release_purged_memory()
+
+    def _cached_bytes(self) -> int:
+        '''
+        Return the system RAM taken up by the models in the cache. A model
+        that is on a CUDA device holds no host copy until it is first
+        offloaded, after which it keeps its pinned host buffers.
+        '''
+        return sum(
+            m['size'] for name, m in self.models.items()
+            if not (self._has_cuda() and name == self.current_model
+                    and not hasattr(m['model'], '_pinned_host_tensors'))
+        )
+
+    def _release_purged_memory(self) -> None:
+        # a full collection is needed here: the conv layers hold
+        # bound methods of themselves (see seamless.py), and the
+        # model long ago aged into the oldest GC generation
+        gc.collect()
+        # the cache really shrank, so hand the memory back
+        if self._has_cuda():
+            torch.cuda.empty_cache()
 
     def print_vram_usage(self) -> None:
         if self._has_cuda:
@@ -352,67 +434,278 @@ class ModelCache(object):
 
     def _invalidate_cached_model(self,model_name:str) -> None:
         self.offload_model(model_name)
-        if model_name in self.stack:
-            self.stack.remove(model_name)
+        self.stack.pop(model_name,None)
         self.models.pop(model_name,None)
 
     def _model_to_cpu(self,model):
         if self.device != 'cpu':
             model.cond_stage_model.device = 'cpu'
-            model.first_stage_model.to('cpu')
-            model.cond_stage_model.to('cpu')
-            model.model.to('cpu')
-            return model.to('cpu')
+            if self._pin_memory:
+                try:
+                    self._copy_to_pinned(model)
+                    return model
+                except RuntimeError as e:
+                    # page-locked memory is limited on some systems (WSL2 in particular)
+                    print(f'** Could not allocate pinned host memory: {str(e)}')
+                    print('** Models will be offloaded to ordinary system RAM from now on')
+                    self._pin_memory = False
+            # the submodels are children of model, so this moves them too
+            model.to('cpu')
+            if self._cpu_cache_dtype():
+                model.to(self._cpu_cache_dtype())
+            return model
         else:
             return model
 
     def _model_from_cpu(self,model):
         if self.device != 'cpu':
-            model.to(self.device)
-            model.first_stage_model.to(self.device)
-            model.cond_stage_model.to(self.device)
+            # the submodels are children of model, so this moves them too.
+            # The copy is queued on the current stream, ahead of any
+            # kernels that will use the weights.
+            if self._cpu_cache_dtype():
+                model.to(self.device, torch.float32, non_blocking=True)
+            else:
+                model.to(self.device, non_blocking=True)
             model.cond_stage_model.device = self.device
         return model
 
+    def _copy_to_pinned(self,model) -> None:
+        '''
+        Copy the model's tensors from the GPU into page-locked host buffers,
+        so that both this copy and the next move back to the GPU run as
+        DMA transfers. The buffers are allocated on the first offload and
+        kept with the model, so later switches neither allocate nor pin
+        host memory. Floating point tensors are converted to the dtype
+        returned by _cpu_cache_dtype(), if any, as they are copied.
+        '''
+        tensors = list(itertools.chain(model.parameters(), model.buffers()))
+        cache_dtype = self._cpu_cache_dtype()
+        dtypes = [cache_dtype if cache_dtype and t.is_floating_point() else t.dtype for t in tensors]
+        pinned = getattr(model, '_pinned_host_tensors', None)
+        if pinned is None or len(pinned) != len(tensors) \
+           or any(p.shape != t.shape or p.dtype != d for p, t, d in zip(pinned, tensors, dtypes)):
+            pinned = [torch.empty(t.shape, dtype=d, pin_memory=True) for t, d in zip(tensors, dtypes)]
+            model._pinned_host_tensors = pinned
+        for host, tensor in zip(pinned, tensors):
+            host.copy_(tensor.data, non_blocking=True)
+            tensor.data = host
+        torch.cuda.synchronize()
+
+    def _model_size(self,model) -> int:
+        '''
+        Return the number of bytes taken up by the model's tensors.
+        '''
+        return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+    def _cpu_cache_dtype(self) -> Optional[torch.dtype]:
+        '''
+        Return the dtype that models are stored at while in the RAM
+        cache, or None if they keep their own. Models that already run
+        at float16 precision are left alone.
+        '''
+        if self.quantize_cpu_cache and self.precision != 'float16':
+            return torch.float16
+        return None
+
     def _pop_oldest_model(self):
         '''
         Remove the first element of the FIFO, which ought
         to be the least recently accessed model. Do not
         pop the last one, because it is in active use!
         '''
-        return self.stack.pop(0)
+        if not self.stack:
+            return None
+        model_name, _ = self.stack.popitem(last=False)
+        return model_name
 
     def _push_newest_model(self,model_name:str) -> None:
         '''
         Maintain a simple FIFO. First element is always the
         least recent, and last element is always the most recent.
         '''
-        with contextlib.suppress(ValueError):
-            self.stack.remove(model_name)
-        self.stack.append(model_name)
+        self.stack.pop(model_name,None)
+        self.stack[model_name] = None
+
+    def _model_configs(self) -> dict:
+        '''
+        Return the model configurations as plain dicts. Looking values up
+        in the OmegaConf tree is slow, and the UI asks for the model list
+        on every refresh, so the conversion is done once and kept until
+        the configuration is changed.
+        '''
+        if self._config_dict is None:
+            self._config_dict = OmegaConf.to_container(self.config, resolve=True)
+        return self._config_dict
 
     def _has_cuda(self) -> bool:
         return self.device.type == 'cuda'
 
-    def _cached_sha256(self,path,data) -> Union[str, bytes]:
-        dirname    = os.path.dirname(path)
-        basename   = os.path.basename(path)
-        base, _    = os.path.splitext(basename)
-        hashpath   = os.path.join(dirname,base+'.sha256')
+    def _resolve_path(self, path:str) -> str:
+        '''
+        Return a models.yaml path in normalized, absolute form. Relative
+        paths are taken to be relative to the InvokeAI root directory.
+        '''
+        return os.path.normpath(os.path.join(Globals.root, path))
+
+    def _is_safetensors(self, path:str) -> bool:
+        return path.endswith('.safetensors')
+
+    def _load_weights(self, model_name:str, path:str):
+        '''
+        Load a weights file, making sure that it cannot run code on the
+        way. safetensors files hold no pickled code. When trust_weights_only
+        is set, pickled checkpoints are first tried with the restricted
+        weights_only unpickler. Otherwise, or if the checkpoint holds other
+        objects (as many that pickle pytorch_lightning state do), the file
+        is scanned with picklescan and then loaded in full.
+
+        The weights_only attempt is only made on torch >= 2.6, as earlier
+        releases could be made to run code through it, and only when the
+        file is memory-mapped, so that an attempt that fails part way has
+        not read the tensors from disk for nothing.
+        '''
+        if self._is_safetensors(path):
+            return self._load_checkpoint(path)
+        if self.trust_weights_only and self.mmap_weights and TORCH_WEIGHTS_ONLY_IS_SAFE:
+            try:
+                return self._load_checkpoint(path, weights_only=True)
+            except pickle.UnpicklingError:
+                print('   | Checkpoint holds objects other than tensors; scanning it')
+        self.scan_model(model_name, path)
+        return self._load_checkpoint(path)
+
+    def _load_checkpoint(self, path:str, weights_only:bool=False):
+        '''
+        Load a weights file onto the CPU. .safetensors files are read
+        with safetensors, which maps the file and builds tensors directly
+        on top of it. Other files go through torch.load(), memory-mapped
+        when mmap_weights is set and both the installed torch (>= 2.1)
+        and the checkpoint format support it. weights_only is passed on
+        to torch.load() when it takes that argument; it is False unless
+        asked for, as newer torch releases default it to True.
+        '''
+        if self._is_safetensors(path):
+            from safetensors.torch import load_file
+            return load_file(path, device='cpu')
+        kwargs = {'weights_only': weights_only} if TORCH_LOAD_HAS_WEIGHTS_ONLY else {}
+        if self.mmap_weights:
+            try:
+                return torch.load(path, map_location='cpu', mmap=True, **kwargs)
+            except TypeError:     # torch.load() has no mmap argument
+                pass
+            except RuntimeError:  # legacy (non-zipfile) checkpoint
+                pass
+        return torch.load(path, map_location='cpu', **kwargs)
+
+    def _sha256_path(self,path) -> str:
+        '''
+        Return the path of the .sha256 file that caches the hash of path.
+        '''
+        base, _ = os.path.splitext(path)
+        return base+'.sha256'
+
+    def _fingerprint_path(self,path) -> str:
+        '''
+        Return the path of the .fingerprint file that records what the
+        weights file looked like when its .sha256 file was written. It is
+        kept apart from the .sha256 file, which older versions of InvokeAI
+        sharing the same models read as a bare hash.
+        '''
+        base, _ = os.path.splitext(path)
+        return base+'.fingerprint'
 
-        if os.path.exists(hashpath) and os.path.getmtime(path) <= os.path.getmtime(hashpath):
-            with open(hashpath) as f:
-                hash = f.read()
+    def _lookup_cached_sha256(self,path) -> Optional[str]:
+        '''
+        Return the cached sha256 hash of the weights file, or None if there
+        is no cached hash or the file has changed since it was hashed. The
+        file is taken to be unchanged if it has the same size as when it
+        was hashed, and either the same modification time or the same
+        fingerprint (see _fingerprint()), so that touching or re-copying
+        a file does not force it to be hashed again. A .sha256 file with
+        no matching .fingerprint file, such as one written by an older
+        version, is used if it is newer than the weights file.
+        '''
+        hashpath = self._sha256_path(path)
+        if not os.path.exists(hashpath):
+            return None
+        with open(hashpath) as f:
+            hash = f.read().strip()
+
+        record = None
+        try:
+            with open(self._fingerprint_path(path)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(record, dict) or record.get('sha256') != hash:
+            if os.path.getmtime(path) <= os.path.getmtime(hashpath):
+                self._store_fingerprint(path, hash)
+                return hash
+            return None
+
+        stat = os.stat(path)
+        if record.get('size') != stat.st_size:
+            return None
+        if record.get('mtime_ns') == stat.st_mtime_ns:
+            return hash
+        if record.get('fingerprint') == self._fingerprint(path):
+            self._store_fingerprint(path, hash)
             return hash
+        return None
 
+    def _store_fingerprint(self,path,hash:str) -> None:
+        '''
+        Record what _lookup_cached_sha256() needs to tell whether the
+        weights file has changed since it was hashed. This only saves
+        time later, so a models directory that cannot be written to is
+        not an error.
+        '''
+        stat = os.stat(path)
+        record = {
+            'sha256': hash,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'fingerprint': self._fingerprint(path),
+        }
+        try:
+            with open(self._fingerprint_path(path),'w') as f:
+                json.dump(record, f)
+        except OSError:  # e.g. a read-only models directory
+            pass
+
+    def _fingerprint(self,path) -> str:
+        '''
+        Return a hash of the first and last FINGERPRINT_SIZE bytes of the
+        file. This takes milliseconds, where hashing a multi-GB weights
+        file in full takes seconds.
+        '''
+        size = os.path.getsize(path)
+        sha = hashlib.sha256()
+        with open(path,'rb') as f:
+            sha.update(f.read(FINGERPRINT_SIZE))
+            if size > FINGERPRINT_SIZE:
+                f.seek(max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE))
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    def _compute_and_store_sha256(self,path) -> str:
+        '''
+        Hash the weights file and cache the result next to it.
+        '''
         print(f'>> Calculating sha256 hash of weights file')
         tic = time.time()
         sha = hashlib.sha256()
-        sha.update(data)
+        if os.path.getsize(path) > 0:
+            # feed the hasher straight from the page cache, without copying
+            # the file through Python bytes objects
+            with open(path,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                for start in range(0, len(view), HASH_CHUNK_SIZE):
+                    sha.update(view[start:start+HASH_CHUNK_SIZE])
         hash = sha.hexdigest()
         toc = time.time()
         print(f'>> sha256 = {hash}','(%4.2fs)' % (toc - tic))
 
-        with open(hashpath,'w') as f:
+        with open(self._sha256_path(path),'w') as f:
             f.write(hash)
+        self._store_fingerprint(path, hash)
         return hash
@@ -9,14 +9,24 @@ Exports function retrieve_metadata(path)
 import os
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
 from PIL import PngImagePlugin, Image
 
 # -------------------image generation utils-----
 
 
 class PngWriter:
-    def __init__(self, outdir):
+    def __init__(self, outdir, background=False):
+        '''
+        If background is True, images are encoded and written by a
+        background thread so that generation does not wait on disk. Writes
+        happen in the order they were requested. Call flush() to wait for
+        the pending writes to finish, and close() when done with the
+        writer, or use it as a context manager.
+        '''
         self.outdir = outdir
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = []
         os.makedirs(outdir, exist_ok=True)
 
     # gives the next unique prefix in outdir
@@ -39,9 +49,41 @@ class PngWriter:
         info.add_text('Dream', dream_prompt)
         if metadata:
             info.add_text('sd-metadata', json.dumps(metadata))
-        image.save(path, 'PNG', pnginfo=info, compress_level=compress_level)
+        if self.executor:
+            self.pending.append(
+                self.executor.submit(image.save, path, 'PNG', pnginfo=info, compress_level=compress_level)
+            )
+        else:
+            image.save(path, 'PNG', pnginfo=info, compress_level=compress_level)
         return path
 
+    def flush(self):
+        '''
+        Wait for all background writes to complete, re-raising the
+        first error encountered.
+        '''
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        '''
+        Wait for all background writes to complete, re-raising the
+        first error encountered, and stop the background thread.
+        '''
+        try:
+            self.flush()
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def retrieve_metadata(self,img_basename):
         '''
         Given a PNG filename stored in outdir, returns the "sd-metadata"
@@ -12,19 +12,28 @@ def configure_model_padding(model, seamless, seamless_axes):
     """
     Modifies the 2D convolution layers to use a circular padding mode based on the `seamless` and `seamless_axes` options.
     """
-    for m in model.modules():
-        if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
-            if seamless:
-                m.asymmetric_padding_mode = {}
-                m.asymmetric_padding = {}
-                m.asymmetric_padding_mode['x'] = 'circular' if ('x' in seamless_axes) else 'constant'
-                m.asymmetric_padding['x'] = (m._reversed_padding_repeated_twice[0], m._reversed_padding_repeated_twice[1], 0, 0)
-                m.asymmetric_padding_mode['y'] = 'circular' if ('y' in seamless_axes) else 'constant'
-                m.asymmetric_padding['y'] = (0, 0, m._reversed_padding_repeated_twice[2], m._reversed_padding_repeated_twice[3])
-                m._conv_forward = _conv_forward_asymmetric.__get__(m, nn.Conv2d)
-            else:
-                m._conv_forward = nn.Conv2d._conv_forward.__get__(m, nn.Conv2d)
-                if hasattr(m, 'asymmetric_padding_mode'):
-                    del m.asymmetric_padding_mode
-                if hasattr(m, 'asymmetric_padding'):
-                    del m.asymmetric_padding
+    # nothing to do if the model is already configured this way
+    padding_config = (True, frozenset(seamless_axes)) if seamless else (False,)
+    if getattr(model, '_padding_config', None) == padding_config:
+        return
+    model._padding_config = padding_config
+
+    # the model cache records the convolution layers when it loads a model
+    conv_modules = getattr(model, '_conv_modules', None)
+    if conv_modules is None:
+        conv_modules = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+    for m in conv_modules:
+        if seamless:
+            m.asymmetric_padding_mode = {}
+            m.asymmetric_padding = {}
+            m.asymmetric_padding_mode['x'] = 'circular' if ('x' in seamless_axes) else 'constant'
+            m.asymmetric_padding['x'] = (m._reversed_padding_repeated_twice[0], m._reversed_padding_repeated_twice[1], 0, 0)
+            m.asymmetric_padding_mode['y'] = 'circular' if ('y' in seamless_axes) else 'constant'
+            m.asymmetric_padding['y'] = (0, 0, m._reversed_padding_repeated_twice[2], m._reversed_padding_repeated_twice[3])
+            m._conv_forward = _conv_forward_asymmetric.__get__(m, nn.Conv2d)
+        else:
+            m._conv_forward = nn.Conv2d._conv_forward.__get__(m, nn.Conv2d)
+            if hasattr(m, 'asymmetric_padding_mode'):
+                del m.asymmetric_padding_mode
+            if hasattr(m, 'asymmetric_padding'):
+                del m.asymmetric_padding
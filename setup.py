@@ -34,6 +34,7 @@ REQUIREMENTS=[
     'torchvision',
     'transformers',
     'picklescan',
+    'safetensors',
     'clip',
     'clipseg',
     'gfpgan',
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import torch
+from omegaconf import OmegaConf
+
+import ldm.invoke.model_cache
+from ldm.invoke.model_cache import ModelCache, FINGERPRINT_SIZE, TORCH_LOAD_HAS_WEIGHTS_ONLY, TORCH_WEIGHTS_ONLY_IS_SAFE
+
+GB = 10**9
+
+
+class Sha256CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.weights = os.path.join(self.dir, 'model.ckpt')
+        with open(self.weights, 'wb') as f:
+            f.write(os.urandom(3 * FINGERPRINT_SIZE))
+        # the hash helpers need no configuration
+        self.cache = ModelCache.__new__(ModelCache)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def set_mtime(self, path, mtime):
+        os.utime(path, (mtime, mtime))
+
+    def test_miss(self):
+        self.assertIsNone(self.cache._lookup_cached_sha256(self.weights))
+
+    def test_hit(self):
+        hash = self.cache._compute_and_store_sha256(self.weights)
+        self.assertEqual(hash, self.cache._lookup_cached_sha256(self.weights))
+
+    def test_sha256_file_is_plain_text(self):
+        hash = self.cache._compute_and_store_sha256(self.weights)
+        with open(self.cache._sha256_path(self.weights)) as f:
+            self.assertEqual(hash, f.read())
+
+    def test_touched_file(self):
+        hash = self.cache._compute_and_store_sha256(self.weights)
+        self.set_mtime(self.weights, 2e9)
+        self.assertEqual(hash, self.cache._lookup_cached_sha256(self.weights))
+
+    def test_changed_file(self):
+        self.cache._compute_and_store_sha256(self.weights)
+        with open(self.weights, 'r+b') as f:
+            f.seek(-5, os.SEEK_END)
+            f.write(b'xxxxx')
+        self.set_mtime(self.weights, 2e9)
+        self.assertIsNone(self.cache._lookup_cached_sha256(self.weights))
+
+    def test_resized_file(self):
+        self.cache._compute_and_store_sha256(self.weights)
+        with open(self.weights, 'ab') as f:
+            f.write(b'x')
+        self.assertIsNone(self.cache._lookup_cached_sha256(self.weights))
+
+    def test_legacy_sha256_file(self):
+        hashpath = self.cache._sha256_path(self.weights)
+        with open(hashpath, 'w') as f:
+            f.write('abc')
+        self.set_mtime(self.weights, 1e9)
+        self.set_mtime(hashpath, 2e9)
+        self.assertEqual('abc', self.cache._lookup_cached_sha256(self.weights))
+        with open(self.cache._fingerprint_path(self.weights)) as f:
+            self.assertEqual('abc', json.load(f)['sha256'])
+
+    def test_stale_legacy_sha256_file(self):
+        hashpath = self.cache._sha256_path(self.weights)
+        with open(hashpath, 'w') as f:
+            f.write('abc')
+        self.set_mtime(self.weights, 2e9)
+        self.set_mtime(hashpath, 1e9)
+        self.assertIsNone(self.cache._lookup_cached_sha256(self.weights))
+
+    def test_sha256_file_rewritten_by_older_version(self):
+        self.cache._compute_and_store_sha256(self.weights)
+        hashpath = self.cache._sha256_path(self.weights)
+        with open(hashpath, 'w') as f:
+            f.write('abc')
+        self.set_mtime(self.weights, 1e9)
+        self.set_mtime(hashpath, 2e9)
+        # the fingerprint vouches for another hash, so fall back to the mtime rule
+        self.assertEqual('abc', self.cache._lookup_cached_sha256(self.weights))
+
+    def test_corrupt_fingerprint_file(self):
+        hash = self.cache._compute_and_store_sha256(self.weights)
+        with open(self.cache._fingerprint_path(self.weights), 'w') as f:
+            f.write('{not json')
+        self.assertEqual(hash, self.cache._lookup_cached_sha256(self.weights))
+
+    def test_unwritable_fingerprint_file(self):
+        hash = self.cache._compute_and_store_sha256(self.weights)
+        # stands in for a read-only models directory, which root could still write to
+        fingerprint_path = self.cache._fingerprint_path(self.weights)
+        os.remove(fingerprint_path)
+        os.mkdir(fingerprint_path)
+        self.assertEqual(hash, self.cache._lookup_cached_sha256(self.weights))
+
+
+class WeightsLoadingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ModelCache.__new__(ModelCache)
+        self.cache.mmap_weights = True
+        self.cache.trust_weights_only = True
+        self.scanned = []
+        self.cache.scan_model = lambda model_name, path: self.scanned.append(model_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def save(self, name, checkpoint, **kwargs):
+        path = os.path.join(self.dir, name)
+        torch.save(checkpoint, path, **kwargs)
+        return path
+
+    def tensors_only(self, **kwargs):
+        return self.save('tensors.ckpt', {'state_dict': {'w': torch.ones(2)}}, **kwargs)
+
+    def with_other_objects(self):
+        # like the hyperparameters pytorch_lightning pickles into checkpoints
+        return self.save('lightning.ckpt', {'state_dict': {'w': torch.ones(2)}, 'hparams': argparse.Namespace(lr=1)})
+
+    @unittest.skipUnless(TORCH_WEIGHTS_ONLY_IS_SAFE, 'needs torch >= 2.6')
+    def test_tensors_load_without_scan(self):
+        sd = self.cache._load_weights('model', self.tensors_only())
+        self.assertTrue(torch.equal(torch.ones(2), sd['state_dict']['w']))
+        self.assertEqual([], self.scanned)
+
+    @unittest.skipUnless(TORCH_LOAD_HAS_WEIGHTS_ONLY, 'needs torch.load(weights_only)')
+    def test_weights_only_rejects_other_objects(self):
+        with self.assertRaises(pickle.UnpicklingError):
+            self.cache._load_checkpoint(self.with_other_objects(), weights_only=True)
+
+    def test_other_objects_are_scanned_then_loaded(self):
+        sd = self.cache._load_weights('model', self.with_other_objects())
+        self.assertEqual(argparse.Namespace(lr=1), sd['hparams'])
+        self.assertEqual(['model'], self.scanned)
+
+    def test_scan_when_not_trusted(self):
+        self.cache.trust_weights_only = False
+        sd = self.cache._load_weights('model', self.with_other_objects())
+        self.assertEqual(argparse.Namespace(lr=1), sd['hparams'])
+        self.assertEqual(['model'], self.scanned)
+
+    def test_scan_on_unsafe_torch(self):
+        with mock.patch.object(ldm.invoke.model_cache, 'TORCH_WEIGHTS_ONLY_IS_SAFE', False):
+            self.cache._load_weights('model', self.tensors_only())
+        self.assertEqual(['model'], self.scanned)
+
+    def test_scan_without_mmap(self):
+        self.cache.mmap_weights = False
+        self.cache._load_weights('model', self.tensors_only())
+        self.assertEqual(['model'], self.scanned)
+
+    def test_legacy_checkpoint(self):
+        # torch.load(mmap=True) raises RuntimeError on the pre-zipfile format
+        path = self.tensors_only(_use_new_zipfile_serialization=False)
+        sd = self.cache._load_weights('model', path)
+        self.assertTrue(torch.equal(torch.ones(2), sd['state_dict']['w']))
+
+    def test_torch_without_mmap(self):
+        load = torch.load
+        def load_without_mmap(*args, **kwargs):
+            if 'mmap' in kwargs:
+                raise TypeError("load() got an unexpected keyword argument 'mmap'")
+            return load(*args, **kwargs)
+        with mock.patch('torch.load', load_without_mmap):
+            sd = self.cache._load_weights('model', self.with_other_objects())
+        self.assertEqual(argparse.Namespace(lr=1), sd['hparams'])
+
+
+class CacheBudgetTestCase(unittest.TestCase):
+
+    def make_cache(self, sizes, max_loaded_models=2, max_cache_bytes=16*GB):
+        '''
+        Return a ModelCache on the CPU whose models "load" instantly and
+        take up sizes[model_name] bytes.
+        '''
+        cache = ModelCache.__new__(ModelCache)
+        cache._config_dict = {name: {} for name in sizes}
+        cache.device = torch.device('cpu')
+        cache.max_loaded_models = max_loaded_models
+        cache.max_cache_bytes = max_cache_bytes
+        cache.quantize_cpu_cache = False
+        cache.models = {}
+        cache.stack = OrderedDict()
+        cache.current_model = None
+        cache._load_model = lambda name: (name, 512, 512, 'hash')
+        cache._model_size = lambda model: sizes[model]
+        cache._model_to_cpu = lambda model: model
+        cache._model_from_cpu = lambda model: model
+        return cache
+
+    def test_models_that_fit_stay_cached(self):
+        # two SD-1.5 sized models in a third of a 16 GB machine
+        cache = self.make_cache({'a': 2.1*GB, 'b': 2.1*GB}, max_cache_bytes=5.3*GB)
+        cache.get_model('a')
+        cache.get_model('b')
+        self.assertEqual({'a', 'b'}, set(cache.models))
+
+    def test_float32_models_stay_cached_by_default(self):
+        # two float32 SD-1.5 models are over a third of a 16 GB machine,
+        # but with no --max_cache_ram only the model count applies
+        cache = self.make_cache({'a': 4.27*GB, 'b': 4.27*GB}, max_cache_bytes=None)
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.get_model('a')
+        self.assertEqual({'a', 'b'}, set(cache.models))
+
+    def test_active_cuda_model_without_host_copy_is_not_charged(self):
+        cache = self.make_cache({'a': 4.27*GB, 'b': 4.27*GB}, max_cache_bytes=5.6*GB)
+        cache.device = torch.device('cuda')
+        cache.get_model('a')
+        cache.get_model('b')
+        self.assertEqual({'a', 'b'}, set(cache.models))
+        self.assertEqual(cache.models['a']['size'], cache._cached_bytes())
+
+    def test_count_limit_purges_least_recent(self):
+        cache = self.make_cache({'a': GB, 'b': GB, 'c': GB})
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.get_model('a')
+        cache.get_model('c')
+        self.assertEqual({'a', 'c'}, set(cache.models))
+        self.assertEqual(['a', 'c'], list(cache.stack))
+
+    def test_byte_limit_purges_least_recent(self):
+        cache = self.make_cache({'a': 2*GB, 'b': 2*GB, 'c': 2*GB}, max_loaded_models=3, max_cache_bytes=5*GB)
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.get_model('c')
+        self.assertEqual({'b', 'c'}, set(cache.models))
+
+    def test_byte_limit_purges_until_under_budget(self):
+        cache = self.make_cache({'a': GB, 'b': GB, 'c': 4.5*GB}, max_loaded_models=3, max_cache_bytes=5*GB)
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.get_model('c')
+        self.assertEqual({'c'}, set(cache.models))
+
+    def test_byte_limit_keeps_current_model(self):
+        cache = self.make_cache({'a': GB, 'big': 8*GB}, max_cache_bytes=5*GB)
+        cache.get_model('a')
+        cache.get_model('big')
+        self.assertEqual({'big'}, set(cache.models))
+        self.assertEqual('big', cache.current_model)
+
+    def test_switching_back_does_not_purge(self):
+        cache = self.make_cache({'a': 2*GB, 'b': 2*GB}, max_cache_bytes=5*GB)
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.get_model('a')
+        self.assertEqual({'a', 'b'}, set(cache.models))
+        self.assertEqual(['b', 'a'], list(cache.stack))
+
+    def test_deleted_model_leaves_the_cache(self):
+        cache = self.make_cache({'a': 2*GB, 'b': 2*GB, 'c': 2*GB}, max_loaded_models=3, max_cache_bytes=5*GB)
+        cache.config = OmegaConf.create({'a': {}, 'b': {}, 'c': {}})
+        cache.get_model('a')
+        cache.get_model('b')
+        cache.del_model('a')
+        self.assertEqual({'b'}, set(cache.models))
+        self.assertEqual(2*GB, cache._cached_bytes())
+        # 'b' would be purged to make room if 'a' were still counted
+        cache.get_model('c')
+        self.assertEqual({'b', 'c'}, set(cache.models))
+
+
+if __name__ == '__main__':
+    unittest.main()
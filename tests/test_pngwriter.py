@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ldm.invoke.pngwriter import PngWriter
+
+
+class FakeImage:
+    '''
+    Stands in for a PIL image. save() optionally waits, so that a
+    background write is still pending when the caller moves on, and
+    records the order in which files are written.
+    '''
+    def __init__(self, written, delay=0, error=None):
+        self.written = written
+        self.delay = delay
+        self.error = error
+
+    def save(self, path, format, **kwargs):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        with open(path, 'wb'):
+            pass
+        self.written.append(os.path.basename(path))
+
+
+class PngWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def save(self, writer, name, **kwargs):
+        return writer.save_image_and_prompt_to_png(FakeImage(self.written, **kwargs), 'prompt', name)
+
+    def test_writes_happen_in_order(self):
+        with PngWriter(self.outdir, background=True) as writer:
+            self.save(writer, '000001.1.png', delay=0.2)
+            self.save(writer, '000002.1.png')
+            self.save(writer, '000003.1.png', delay=0.1)
+        self.assertEqual(['000001.1.png', '000002.1.png', '000003.1.png'], self.written)
+
+    def test_writes_happen_in_background(self):
+        writer = PngWriter(self.outdir, background=True)
+        self.save(writer, '000001.1.png', delay=0.2)
+        self.assertEqual([], self.written)
+        writer.close()
+        self.assertEqual(['000001.1.png'], self.written)
+
+    def test_flush_reraises_failed_write(self):
+        writer = PngWriter(self.outdir, background=True)
+        self.save(writer, '000001.1.png', error=OSError('disk full'))
+        self.save(writer, '000002.1.png')
+        with self.assertRaises(OSError):
+            writer.flush()
+        # later writes still happen, and the failure is only reported once
+        writer.close()
+        self.assertEqual(['000002.1.png'], self.written)
+
+    def test_close_stops_the_background_thread(self):
+        writer = PngWriter(self.outdir, background=True)
+        self.save(writer, '000001.1.png')
+        writer.close()
+        self.assertIsNone(writer.executor)
+        # a writer that has been closed writes in the foreground
+        self.save(writer, '000002.1.png')
+        self.assertEqual(['000001.1.png', '000002.1.png'], self.written)
+
+    def test_unique_prefix_after_close_sees_pending_files(self):
+        writer = PngWriter(self.outdir, background=True)
+        self.save(writer, '000001.1.png', delay=0.1)
+        self.save(writer, '000002.1.png', delay=0.1)
+        writer.close()
+        self.assertEqual('000003', PngWriter(self.outdir).unique_prefix())
+
+    def test_foreground_writes(self):
+        writer = PngWriter(self.outdir)
+        self.save(writer, '000001.1.png')
+        self.assertEqual(['000001.1.png'], self.written)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()